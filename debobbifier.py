@@ -1,18 +1,47 @@
 #!/usr/bin/env python
 # author: Bob Whelton <robert@whelton.net>
 
-from collections import defaultdict
-from os import getcwd, walk, mkdir, makedirs
-from os.path import join, exists, getmtime, relpath, islink
-from shutil import copystat, copy2
-from time import ctime, sleep
+from errno import ELOOP, EXDEV, ENOSYS, EOPNOTSUPP, EINVAL
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from itertools import accumulate, groupby
+from operator import itemgetter
+from os import getcwd, scandir, makedirs, link, open as open_fd, close, fstat, ftruncate, \
+    O_RDONLY, O_WRONLY, O_CREAT, O_DIRECTORY, O_NOFOLLOW, O_NONBLOCK
+from os.path import join, exists, isdir, relpath, samestat
+from stat import S_ISREG
+from shutil import copystat, copy2, SameFileError
+from tempfile import mkstemp
+from time import ctime, sleep, monotonic
+from typing import Dict, List, Optional, Tuple
 import argparse
-from json import dumps, load, dump
+import csv
+import sys
+from json import dumps, loads
+from json.encoder import encode_basestring_ascii
+
+try:
+    from orjson import dumps as encode_json, loads as decode_json
+except ImportError:
+    encode_json = None
+    try:
+        from ujson import loads as decode_json
+    except ImportError:
+        decode_json = loads
+
+try:
+    from os import copy_file_range
+except ImportError:
+    copy_file_range = None
 
 
 REPORT_NAME = 'duplication-report'
 UNREADABLE_REPORT_NAME = 'unreadable-files-report'
 TARGET_DIR = 'DEDUPLICATED'
+WALK_WORKERS = 32
+COPY_WORKERS = 16
+OUTPUT_BUFFER_SIZE = 8 * 1024 * 1024
+PROGRESS_INTERVAL = 0.25
 
 
 def verify():
@@ -21,71 +50,320 @@ def verify():
     print("Nope.")
 
 
+class Entries:
+    """
+    The locations where one filename was found, held as parallel lists rather than a dict per location.
+    missing holds the indexes of the locations where the file disappeared before it could be examined, and
+    inodes the (device, inode) of each location that is one of several hard links to the same file.
+    """
+    __slots__ = ('dirs', 'mtimes', 'missing', 'inodes')
+
+    def __init__(self, dirs=None, mtimes=None, missing=None, inodes=None):
+        self.dirs = [] if dirs is None else dirs
+        self.mtimes = [] if mtimes is None else mtimes
+        self.missing = [] if missing is None else missing
+        self.inodes = {} if inodes is None else inodes
+
+    def __len__(self):
+        return len(self.dirs)
+
+    def append(self, directory: str, mtime, inode=None):
+        """
+        :param mtime: the last modification time, or None if the file was not found
+        :param inode: the (device, inode) of the file if it has more than one hard link
+        """
+        if mtime is None:
+            self.missing.append(len(self.dirs))
+            mtime = 0.0
+        if inode is not None:
+            self.inodes[len(self.dirs)] = inode
+        self.dirs.append(directory)
+        self.mtimes.append(mtime)
+
+    def newest(self) -> int:
+        """
+        :return: the index of the most recently modified location, the last one found if several tie
+        """
+        return max(reversed(range(len(self.mtimes))), key=self.mtimes.__getitem__)
+
+    def by_last_modified(self, reverse=False):
+        """
+        :return: the indexes of the locations, in order of their last modification time
+        """
+        return sorted(range(len(self.mtimes)), key=self.mtimes.__getitem__, reverse=reverse)
+
+    def records(self):
+        """
+        :return: the locations as one dict per location, for display
+        """
+        records = [{'directory': d, 'last_modified': m} for d, m in zip(self.dirs, self.mtimes)]
+        for index in self.missing:
+            records[index]['file not found'] = True
+        return records
+
+    def to_json(self, file: str) -> bytes:
+        if encode_json is not None:
+            group = {'file': file, 'dirs': self.dirs, 'mtimes': self.mtimes}
+            if self.missing:
+                group['missing'] = self.missing
+            if self.inodes:
+                group['inodes'] = [[index, dev, ino] for index, (dev, ino) in self.inodes.items()]
+            try:
+                return encode_json(group)
+            except TypeError:
+                # orjson refuses names that are not valid UTF-8, which the template below escapes
+                pass
+        text = f'{{"file":{encode_basestring_ascii(file)}' \
+               f',"dirs":[{",".join(map(encode_basestring_ascii, self.dirs))}]' \
+               f',"mtimes":[{",".join(map(repr, self.mtimes))}]'
+        if self.missing:
+            text += f',"missing":[{",".join(map(str, self.missing))}]'
+        if self.inodes:
+            text += f',"inodes":[{",".join(f"[{i},{dev},{ino}]" for i, (dev, ino) in self.inodes.items())}]'
+        return f'{text}}}'.encode()
+
+    @staticmethod
+    def from_json(line: bytes):
+        try:
+            group = decode_json(line)
+        except ValueError:
+            # the standard library decoder also accepts escaped names that are not valid UTF-8
+            group = loads(line)
+        inodes = {index: (dev, ino) for index, dev, ino in group.get('inodes', ())}
+        return group['file'], Entries(group['dirs'], group['mtimes'], group.get('missing'), inodes)
+
+
+class CtimeCache(dict):
+    """
+    Maps modification times to their ctime() text, converting each distinct time only once.
+    Many files share a timestamp, e.g. those unpacked from an archive or restored from a backup.
+    """
+    def __missing__(self, mtime):
+        text = self[mtime] = ctime(mtime)
+        return text
+
+
+def read_report(report_file):
+    """
+    Reads a report one line at a time, so that only one file's entries are held in memory.
+    :param report_file: the report, opened in binary mode
+    :return: a generator of (filename, Entries) pairs, in filename order
+    """
+    for line in report_file:
+        yield Entries.from_json(line)
+
+
 def print_report(clargs, report_name: str):
     if exists(report_name):
-        with open(report_name) as report_file:
-            found_files = load(report_file)
-        if clargs.counts:
-            counts = []
-            for file, entries in found_files.items():
-                entries.sort(key=lambda x: x['last_modified'])
-                counts.append((len(entries), file, entries[-1]['directory']))
-            print(f"count  filename, director last found in")
-            print(f"------+--------------------------------------------------------------------------")
-            counts.sort(key=lambda x: x[0])
-            for count, file, directory in counts:
-                print(f"{count:>5} | {file}")
-                print(f"      | {directory}")
-        elif clargs.json:
-            for file, entries in found_files.items():
-                for record in entries:
-                    record['last_modified'] = ctime(record['last_modified'])
-            print(dumps(found_files, indent=2, sort_keys=True))
-        else:
-            print("filename,modified timestamp,director,modified timestamp,directory,...")
-            for file, entries in sorted(found_files.items()):
-                file = file.replace('"', "'")
-                print(f'"{file}"', end=',')
-                entries.sort(key=lambda x: x['last_modified'], reverse=True)
-                for info in entries:
-                    directory = info["directory"].replace('"', "'")
-                    print(ctime(info["last_modified"]), end=',')
-                    print(f'"{directory}"', end=',')
-                print(end='\n')
+        ctimes = CtimeCache()
+        with open(report_name, 'rb') as report_file:
+            if clargs.counts:
+                counts = []
+                for file, entries in read_report(report_file):
+                    counts.append((len(entries), file, entries.dirs[entries.newest()]))
+                print(f"count  filename, director last found in")
+                print(f"------+--------------------------------------------------------------------------")
+                counts.sort(key=lambda x: x[0])
+                for count, file, directory in counts:
+                    print(f"{count:>5} | {file}")
+                    print(f"      | {directory}")
+            elif clargs.json:
+                found_files = {}
+                for file, entries in read_report(report_file):
+                    records = entries.records()
+                    for record in records:
+                        record['last_modified'] = ctimes[record['last_modified']]
+                    found_files[file] = records
+                print(dumps(found_files, indent=2, sort_keys=True))
+            else:
+                print("filename,modified timestamp,director,modified timestamp,directory,...")
+                writer = csv.writer(sys.stdout, lineterminator='\n')
+                for file, entries in read_report(report_file):
+                    row = [file]
+                    for index in entries.by_last_modified(reverse=True):
+                        row.append(ctimes[entries.mtimes[index]])
+                        row.append(entries.dirs[index])
+                    writer.writerow(row)
     else:
         print(f"no report by the name of '{report_name}' was found in the current directory '{getcwd()}'")
 
 
-def generate_report(directories: list):
-    found_files = defaultdict(list)
-    for search_dir in directories:
-        print(f"searching all files in {search_dir}")
-        for path, dirs, files in walk(search_dir):
-            for f in files:
-                if not (f.startswith('.') or islink(join(path, f))):
-                    record = {'directory': relpath(path)}
+def scan_directory(path: str, cwd: str):
+    """
+    Lists a single directory, as one unit of work for the walker threads.
+    :param path: the directory to list
+    :param cwd: the directory that the reported directories are relative to
+    :return: the (filename, directory, mtime, inode) of the files found in it, where inode is the
+        (device, inode) of files with more than one hard link and None otherwise, and the subdirectories
+        still to be searched
+    """
+    files = []
+    subdirs = []
+    try:
+        dir_fd = open_fd(path, O_RDONLY | O_DIRECTORY)
+    except OSError:
+        return files, subdirs
+    directory = relpath(path, cwd)
+    try:
+        # scanning by descriptor makes entry.stat() an fstatat() relative to it,
+        # rather than a lookup of the whole path from the root for every file
+        with scandir(dir_fd) as entries:
+            for entry in entries:
+                if entry.is_symlink():
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(join(path, entry.name))
+                elif not entry.name.startswith('.'):
                     try:
-                        record['last_modified'] = getmtime(join(path, f))
+                        st = entry.stat(follow_symlinks=False)
                     except FileNotFoundError:
-                        record['last_modified'] = 0.0
-                        record['file not found'] = True
-                    found_files[f].append(record)
-    report_name = REPORT_NAME
-    tries = 0
-    while exists(f"{report_name}.txt") and tries < 1000:
-        tries += 1
-        if '_' in report_name:
-            name, number = report_name.split('_')
-            number = int(number) + 1
-            report_name = f"{name}_{number}"
-        else:
-            report_name = f"{report_name}_1"
-    if tries < 1000:
-        with open(f'{report_name}.txt', 'w') as report_file:
-            dump(found_files, report_file, indent=2)
-        print(f"I have written the report to '{join(getcwd(), f'{report_name}.txt')}'. Goodbye.")
+                        files.append((entry.name, directory, None, None))
+                        continue
+                    inode = (st.st_dev, st.st_ino) if st.st_nlink > 1 else None
+                    files.append((entry.name, directory, st.st_mtime, inode))
+    finally:
+        close(dir_fd)
+    return files, subdirs
+
+
+def generate_report(directories: list):
+    found_files = []
+    cwd = getcwd()
+    with ThreadPoolExecutor(max_workers=WALK_WORKERS) as executor:
+        pending = set()
+        for search_dir in directories:
+            print(f"searching all files in {search_dir}")
+            pending.add(executor.submit(scan_directory, search_dir, cwd))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                found_files.extend(files)
+                for subdir in subdirs:
+                    pending.add(executor.submit(scan_directory, subdir, cwd))
+    found_files.sort(key=itemgetter(0, 1))
+    report_fd, report_path = mkstemp(prefix=f'{REPORT_NAME}_', suffix='.txt', dir=cwd)
+    with open(report_fd, 'wb', buffering=OUTPUT_BUFFER_SIZE) as report_file:
+        for file, group in groupby(found_files, key=itemgetter(0)):
+            entries = Entries()
+            for _, directory, mtime, inode in group:
+                entries.append(directory, mtime, inode)
+            report_file.write(entries.to_json(file) + b'\n')
+    print(f"I have written the report to '{report_path}'. Goodbye.")
+
+
+def copy_data(src: str, dst: str):
+    """
+    Copies a file like copy2(src, dst, follow_symlinks=False), but with copy_file_range(), which keeps the
+    data in the kernel and lets filesystems that support it (btrfs, XFS, NFS 4.2, ...) share it instead.
+    Anything copy_file_range() cannot do, like special files or copies across filesystems, goes to copy2.
+    """
+    if copy_file_range is None:
+        copy2(src, dst, follow_symlinks=False)
+        return
+    try:
+        src_fd = open_fd(src, O_RDONLY | O_NOFOLLOW | O_NONBLOCK)
+    except OSError as e:
+        if e.errno != ELOOP:
+            raise
+        copy2(src, dst, follow_symlinks=False)
+        return
+    copied = False
+    try:
+        src_stat = fstat(src_fd)
+        if S_ISREG(src_stat.st_mode):
+            dst_fd = open_fd(dst, O_WRONLY | O_CREAT, 0o666)
+            try:
+                if samestat(src_stat, fstat(dst_fd)):
+                    raise SameFileError(f"{src!r} and {dst!r} are the same file")
+                ftruncate(dst_fd, 0)
+                count = max(src_stat.st_size, 1024 * 1024)
+                try:
+                    while copy_file_range(src_fd, dst_fd, count):
+                        pass
+                    copied = True
+                except OSError as e:
+                    if e.errno not in (EXDEV, ENOSYS, EOPNOTSUPP, EINVAL):
+                        raise
+            finally:
+                close(dst_fd)
+    finally:
+        close(src_fd)
+    if copied:
+        copystat(src, dst, follow_symlinks=False)
     else:
-        print(f"Unable to create a uniquely named report. Please delete files with names like '{report_name}'")
+        copy2(src, dst, follow_symlinks=False)
+
+
+def copy_file(src: str, dst: str):
+    """
+    Copies one file, as one unit of work for the copier threads.
+    :return: a description of the failure if the file could not be read, otherwise None
+    """
+    try:
+        copy_data(src, dst)
+    except SameFileError:
+        pass
+    except PermissionError as e:
+        return f"{e}, src='{src}', dst='{dst}'"
+
+
+def link_file(first, first_dst: str, src: str, dst: str):
+    """
+    Hard links dst to the copy already made of another hard link to the same source file, so that its data is
+    not copied twice. Falls back to copying if that copy failed or the link cannot be made.
+    :param first: the future of the copy to first_dst, which was submitted before this one
+    :return: as for copy_file
+    """
+    if first.result() is None:
+        try:
+            link(first_dst, dst)
+            return None
+        except OSError:
+            pass
+    return copy_file(src, dst)
+
+
+def log_failed_copies(copies, unreadable):
+    for copy in copies:
+        error = copy.result()
+        if error:
+            print(error, file=unreadable)
+
+
+@lru_cache(maxsize=None)
+def leading_paths(directory: str) -> tuple:
+    """
+    :return: every leading path of the directory, e.g. ('a', 'a/b', 'a/b/c') for 'a/b/c'
+    """
+    return tuple(accumulate(directory.split('/'), join))
+
+
+@lru_cache(maxsize=None)
+def destination_path(dest: str, directory: str) -> str:
+    return join(TARGET_DIR, dest, directory)
+
+
+def newest_copies(entries: Entries,
+                  destinations: Dict[str, str]) -> List[Tuple[str, str, str, Optional[Tuple[int, int]]]]:
+    """
+    Picks the copy of one file to keep in each destination directory: the most recently modified one among
+    the accounts that share the destination.
+    :param entries: the locations of the file, as '<account>/<directory>'
+    :param destinations: the destination of each account
+    :return: a (destination, directory, account, inode) for each directory the file is to be copied to, where
+        inode is the (device, inode) of the chosen copy if it has other hard links and None otherwise
+    """
+    newest: Dict[Tuple[str, str], Tuple[float, str, int]] = {}
+    for index, (record_dir, mtime) in enumerate(zip(entries.dirs, entries.mtimes)):
+        if '/' in record_dir:
+            account, directory = record_dir.split('/', maxsplit=1)
+            key = (destinations[account], directory)
+            best = newest.get(key)
+            if best is None or mtime >= best[0]:
+                newest[key] = (mtime, account, index)
+    return [(dest, directory, account, entries.inodes.get(index))
+            for (dest, directory), (_, account, index) in newest.items()]
 
 
 def deduplicate(destination_specs: list, report_name: str):
@@ -104,44 +382,53 @@ def deduplicate(destination_specs: list, report_name: str):
             for account in accounts.split(','):
                 destinations[account] = dest
         if exists(report_name):
-            with open(f"{UNREADABLE_REPORT_NAME}.txt", 'w') as unreadable:
-                with open(report_name) as report_file:
-                    found_files = load(report_file)
+            with open(f"{UNREADABLE_REPORT_NAME}.txt", 'w', buffering=1) as unreadable, \
+                    open(report_name, 'rb') as report_file, \
+                    ThreadPoolExecutor(max_workers=COPY_WORKERS) as executor:
                 count = 0
-                total = len(found_files)
-                last_percent = 0
+                total = sum(1 for _ in report_file)
+                report_file.seek(0)
+                last_print = monotonic()
+                created = set()
+                copies = set()
+                linked_copies = {}
                 print(f"deduplicating {total} files...")
-                for file, entries in found_files.items():
+                for file, entries in read_report(report_file):
                     count += 1
-                    percent = int(count / total * 100)
-                    if percent > last_percent:
-                        print(f"{percent:>3}% completed")
-                        last_percent = percent
-                    data = defaultdict(lambda: defaultdict(list))
-                    for record in entries:
-                        if '/' in record['directory']:
-                            account, directory = record['directory'].split('/', maxsplit=1)
-                            dest = destinations[account]
-                            data[dest][directory].append(
-                                {'account': account, 'last_modified': record['last_modified']})
-                    for dest, directories in data.items():
-                        for directory, items in directories.items():
-                            items.sort(key=lambda x: x['last_modified'])
-                            info = items[-1]
-                            path = ''
-                            for d in directory.split('/'):
-                                path = join(path, d)
-                                try:
-                                    mkdir(join(TARGET_DIR, dest, path))
-                                    copystat(join(info['account'], path), join(TARGET_DIR, dest, path))
-                                except FileExistsError:
-                                    pass
-                            src = join(info['account'], directory, file)
-                            dst = join(TARGET_DIR, dest, directory, file)
-                            try:
-                                copy2(src, dst, follow_symlinks=False)
-                            except PermissionError as e:
-                                print(f"{e}, src='{src}', dst='{dst}'", file=unreadable, flush=True)
+                    now = monotonic()
+                    if now - last_print > PROGRESS_INTERVAL:
+                        sys.stdout.write(f"\r{int(count / total * 100):>3}% completed")
+                        sys.stdout.flush()
+                        last_print = now
+                    for dest, directory, account, inode in newest_copies(entries, destinations):
+                        dst_dir = destination_path(dest, directory)
+                        if dst_dir not in created:
+                            new_paths = []
+                            for path in leading_paths(directory):
+                                dst_path = destination_path(dest, path)
+                                # below the first missing directory, every directory is missing
+                                if new_paths or (dst_path not in created and not isdir(dst_path)):
+                                    new_paths.append(path)
+                                created.add(dst_path)
+                            makedirs(dst_dir, exist_ok=True)
+                            for path in new_paths:
+                                copystat(join(account, path), destination_path(dest, path))
+                        src = join(account, directory, file)
+                        dst = join(dst_dir, file)
+                        if inode in linked_copies:
+                            first_dst, first = linked_copies[inode]
+                            copies.add(executor.submit(link_file, first, first_dst, src, dst))
+                        else:
+                            copy = executor.submit(copy_file, src, dst)
+                            copies.add(copy)
+                            if inode is not None:
+                                linked_copies[inode] = (dst, copy)
+                        if len(copies) >= 4 * COPY_WORKERS:
+                            done, copies = wait(copies, return_when=FIRST_COMPLETED)
+                            log_failed_copies(done, unreadable)
+                log_failed_copies(copies, unreadable)
+                if total:
+                    print("\r100% completed")
         else:
             print(f"no report by the name of '{report_name}' was found in the current directory '{getcwd()}'")
     else: